@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # /// script
 # dependencies = [
+#     "aiolimiter>=1.1.0,<1.4",
+#     "httpx[http2]>=0.23.0",
 #     "mutagen>=1.47.0",
-#     "openai>=1.0.0",
+#     "openai>=1.17.0",
+#     "orjson>=3.0.0",
 #     "python-dotenv>=1.0.0",
+#     "tiktoken>=0.7.0",
 # ]
 # ///
 """
@@ -12,54 +16,129 @@ Usage: uv run music_tagger.py [OPTIONS] FILES...
 """
 
 import argparse
+import asyncio
+import hashlib
 import json
 import os
+import sqlite3
 import sys
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import random
 
 try:
-    from mutagen import File as MutagenFile
+    import httpx
+    import tiktoken
+    from aiolimiter import AsyncLimiter
+    from mutagen import File as MutagenFile, FileType, MutagenError
+    from mutagen.aiff import AIFF
+    from mutagen.asf import ASF
+    from mutagen.flac import FLAC
     from mutagen.id3 import ID3, TCON
-    from openai import OpenAI
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4
+    from mutagen.oggvorbis import OggVorbis
+    from mutagen.wave import WAVE
+    from openai import APIError, AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError
     from dotenv import load_dotenv
 except ImportError as e:
     print(f"Error: Missing required package: {e.name}")
-    print("Install with: uv add mutagen openai python-dotenv")
+    print("Install with: uv add aiolimiter 'httpx[http2]' mutagen openai python-dotenv tiktoken")
     sys.exit(1)
 
+# orjson parses API responses several times faster, but is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+
+# Client-side request/token buckets so requests are paced at the rate limit
+# instead of running into it. Resized in place from the x-ratelimit-limit-*
+# response headers once the real limits for the account are known.
+_rpm_limiter = AsyncLimiter(500, 60)
+_tpm_limiter = AsyncLimiter(500_000, 60)
+
+# Token amounts requests are currently waiting for in _tpm_limiter. The limiter
+# is never shrunk below the largest of these, or that request could never fit.
+_tpm_pending = Counter()
+
+CACHE_PATH = '~/.music_tagger_cache.db'
+
+# Prompt size to aim for when picking the batch size automatically
+TARGET_PROMPT_TOKENS = 4000
+
+AUDIO_EXTENSIONS = {'.mp3', '.m4a', '.flac', '.wav', '.aac', '.ogg', '.wma', '.aif', '.aiff'}
+
+# Parser for each extension, so files don't need to be sniffed by MutagenFile
+_PARSERS = {
+    '.mp3': MP3,
+    '.m4a': MP4,
+    '.flac': FLAC,
+    '.wav': WAVE,
+    '.ogg': OggVorbis,
+    '.wma': ASF,
+    '.aif': AIFF,
+    '.aiff': AIFF,
+}
+
+# Artist, album and title tag keys for each tag format
+_ID3_METADATA_KEYS = {'artist': 'TPE1', 'album': 'TALB', 'title': 'TIT2'}
+_DEFAULT_METADATA_KEYS = {'artist': 'ARTIST', 'album': 'ALBUM', 'title': 'TITLE'}
+_METADATA_KEYS = {
+    MP4: {'artist': '\xa9ART', 'album': '\xa9alb', 'title': '\xa9nam'},
+    ASF: {'artist': 'Author', 'album': 'WM/AlbumTitle', 'title': 'Title'},
+}
+
+# Genre tag key for formats that don't use ID3 tags
+_GENRE_KEYS = {
+    MP4: '\xa9gen',
+    FLAC: 'GENRE',
+    OggVorbis: 'GENRE',
+    ASF: 'WM/Genre',
+}
+
+# Birth time is only available on macOS (and BSDs); elsewhere ctime is the
+# closest approximation of when a file was created
+_HAS_BIRTHTIME = hasattr(os.stat_result, 'st_birthtime')
+
+
+def open_audio_file(file_path: str) -> Optional[FileType]:
+    """Open a music file with the mutagen parser for its extension."""
+    parser = _PARSERS.get(os.path.splitext(file_path)[1].lower())
+    try:
+        return parser(file_path) if parser else MutagenFile(file_path)
+    except MutagenError:
+        # Contents don't match the extension, let mutagen detect the format
+        return MutagenFile(file_path)
+
 
 def extract_metadata(file_path: str) -> Optional[Dict[str, str]]:
     """Extract artist, album, and track title from music file."""
     try:
-        audio_file = MutagenFile(file_path)
+        audio_file = open_audio_file(file_path)
         if audio_file is None:
             return None
         
-        # Try different tag formats
         metadata = {}
+        if audio_file.tags is None:
+            return metadata
         
-        # Get artist
-        artist = (audio_file.get('TPE1') or audio_file.get('\xa9ART') or 
-                 audio_file.get('ARTIST') or audio_file.get('artist'))
-        if artist:
-            metadata['artist'] = str(artist[0]) if isinstance(artist, list) else str(artist)
-        
-        # Get album
-        album = (audio_file.get('TALB') or audio_file.get('\xa9alb') or 
-                audio_file.get('ALBUM') or audio_file.get('album'))
-        if album:
-            metadata['album'] = str(album[0]) if isinstance(album, list) else str(album)
+        # Pick the tag keys for this file's tag format
+        if isinstance(audio_file.tags, ID3):
+            keys = _ID3_METADATA_KEYS
+        else:
+            keys = _METADATA_KEYS.get(type(audio_file), _DEFAULT_METADATA_KEYS)
         
-        # Get title
-        title = (audio_file.get('TIT2') or audio_file.get('\xa9nam') or 
-                audio_file.get('TITLE') or audio_file.get('title'))
-        if title:
-            metadata['title'] = str(title[0]) if isinstance(title, list) else str(title)
+        for field, key in keys.items():
+            value = audio_file.tags.get(key)
+            if value:
+                metadata[field] = str(value[0]) if isinstance(value, list) else str(value)
         
         return metadata
     except Exception as e:
@@ -67,27 +146,76 @@ def extract_metadata(file_path: str) -> Optional[Dict[str, str]]:
         return None
 
 
-def process_batch(batch: List[Dict], api_key: str, batch_num: int, total_batches: int) -> Dict:
-    """Process a single batch of tracks and return metadata."""
-    print(f"Processing batch {batch_num}/{total_batches} ({len(batch)} tracks)...")
-    return get_chatgpt_metadata(batch, api_key)
+def open_cache(path: str) -> sqlite3.Connection:
+    """Open the on-disk cache of AI metadata, creating it if needed."""
+    cache = sqlite3.connect(os.path.expanduser(path))
+    cache.execute('PRAGMA journal_mode=WAL')
+    cache.execute('PRAGMA synchronous=NORMAL')
+    cache.execute('CREATE TABLE IF NOT EXISTS ai_metadata (key TEXT PRIMARY KEY, json TEXT)')
+    return cache
 
 
-def get_chatgpt_metadata(tracks: List[Dict], api_key: str) -> Dict:
-    """Get metadata from ChatGPT for the given tracks."""
-    client = OpenAI(api_key=api_key)
-    
-    # Format tracks for the prompt
-    track_list = []
+def cache_key(metadata: Dict[str, str]) -> str:
+    """Build a cache key from a track's normalized artist, album, and title."""
+    fields = [metadata.get(field, '').strip().lower() for field in ('artist', 'album', 'title')]
+    return hashlib.sha256('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+
+def _is_track_metadata(value) -> bool:
+    """Check that an AI result for one track has the genres/region/era shape."""
+    if not isinstance(value, dict):
+        return False
+    genres = value.get('genres', [])
+    region = value.get('region', [])
+    return (isinstance(genres, list) and all(isinstance(genre, str) for genre in genres)
+            and (isinstance(region, str)
+                 or isinstance(region, list) and all(isinstance(r, str) for r in region))
+            and isinstance(value.get('era'), (str, type(None))))
+
+
+def cache_get(cache: sqlite3.Connection, metadata: Dict[str, str]) -> Optional[Dict]:
+    """Look up cached AI metadata for a track."""
+    row = cache.execute('SELECT json FROM ai_metadata WHERE key = ?', (cache_key(metadata),)).fetchone()
+    if row is None:
+        return None
+    # Ignore rows written before entries were validated
+    cached = json_loads(row[0])
+    return cached if _is_track_metadata(cached) else None
+
+
+def cache_put(cache: sqlite3.Connection, tracks: List[Dict], ai_metadata: Dict) -> None:
+    """Store the AI metadata returned for the given tracks."""
+    rows = []
     for track in tracks:
-        artist = track['metadata'].get('artist', 'Unknown')
-        album = track['metadata'].get('album', 'Unknown')
-        title = track['metadata'].get('title', 'Unknown')
-        track_list.append(f"Artist: {artist} | Track: {title} | Album: {album}")
-    
-    tracks_text = '\n'.join(track_list)
+        # Don't cache malformed replies, or they'd be reused on every run
+        entry = ai_metadata.get(track['track_key'])
+        if _is_track_metadata(entry):
+            rows.append((cache_key(track['metadata']), json.dumps(entry)))
     
-    prompt = f"""
+    with cache:
+        cache.executemany('INSERT OR REPLACE INTO ai_metadata (key, json) VALUES (?, ?)', rows)
+
+
+async def process_batch(client: AsyncOpenAI, batch: List[List[Dict]], batch_num: int, total_batches: int,
+                        semaphore: asyncio.Semaphore,
+                        cache: Optional[sqlite3.Connection] = None) -> Tuple[List[List[Dict]], Dict]:
+    """Process a single batch of track groups and return it with its metadata."""
+    tracks = [group[0] for group in batch]
+    async with semaphore:
+        print(f"Processing batch {batch_num}/{total_batches} ({len(batch)} tracks)...")
+        try:
+            batch_metadata = await get_chatgpt_metadata(client, tracks)
+        except Exception as e:
+            print(f"Error processing batch {batch_num}: {e}")
+            return batch, {}
+        
+        if cache is not None:
+            cache_put(cache, tracks, batch_metadata)
+        print(f"Completed batch {batch_num}/{total_batches}")
+        return batch, batch_metadata
+
+
+_PROMPT_HEAD = """
 <TASK>
 You're a DJ, categorizing your digital collection into various tags for efficient recall during sets. For the following tracks, please return the following fields:
 - genres (>=1, House, Lo-fi House, Leftfield House, Deep House, Tech House, Minimal, Techno, Dub Techno, Acid House, Acid Techno, Dub, Hip Hop, Rap, R&B, Dubstep, UK Bass, Bass, UK Garage, Disco, Ambient, Experimental, Hypnotic, Electro, Trance, Italo, Edits, Drum & Bass, Jungle, Breaks, Happy Hardcore, IDM, Footwork, Reggae, Pop, Downtempo)
@@ -103,110 +231,291 @@ You're a DJ, categorizing your digital collection into various tags for efficien
 
 <OUTPUT_FORMAT>
 Return the results as JSON in this format:
-{{
-  "Artist - Track": {{
+{
+  "Artist - Track": {
     "genres": ["genre1", "genre2"],
     "region": ["region1", "region2"],
     "era": "era"
-  }}
-}}
+  }
+}
 </OUTPUT_FORMAT>
 
 <tracks>
-{tracks_text}
+"""
+
+_PROMPT_TAIL = """
 </tracks>"""
 
+
+def format_track(track: Dict) -> str:
+    """Format a track as a line of the ChatGPT prompt."""
+    metadata = track['metadata']
+    return f"Artist: {metadata.get('artist', 'Unknown')} | Track: {metadata.get('title', 'Unknown')} | Album: {metadata.get('album', 'Unknown')}"
+
+
+def build_prompt(tracks: List[Dict]) -> str:
+    """Build the ChatGPT prompt for the given tracks."""
+    return _PROMPT_HEAD + '\n'.join([format_track(t) for t in tracks]) + _PROMPT_TAIL
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> Optional["tiktoken.Encoding"]:
+    """Get the tokenizer used to estimate prompt sizes, or None if it can't be loaded."""
+    try:
+        try:
+            return tiktoken.encoding_for_model("gpt-5")
+        except KeyError:
+            # Older tiktoken releases don't know about gpt-5 yet
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads the encoding on first use, which fails offline
+        print(f"Warning: Could not load tokenizer, estimating prompt sizes instead: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens in text, or estimate them if there's no tokenizer."""
+    encoding = get_encoding()
+    if encoding is None:
+        # Roughly four characters per token for English text
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def choose_batch_size(tracks: List[Dict], min_batches: int = 1, sample_size: int = 50) -> int:
+    """Pick how many tracks to send per request.
+    
+    Each prompt is filled up to about TARGET_PROMPT_TOKENS, but the tracks are
+    still spread over min_batches requests where possible so they run
+    concurrently and one bad reply can't lose the whole library. Batches are
+    never smaller than 10 tracks.
+    """
+    sample = tracks[:sample_size]
+    avg_tokens = max(1, sum(count_tokens(format_track(t)) for t in sample) / len(sample))
+    available_tokens = TARGET_PROMPT_TOKENS - count_tokens(_PROMPT_HEAD + _PROMPT_TAIL)
+    batch_size = min(int(available_tokens / avg_tokens), (len(tracks) + min_batches - 1) // min_batches)
+    return max(10, batch_size)
+
+
+def _resize_limiter(limiter: AsyncLimiter, max_rate: int) -> None:
+    """Change a limiter's rate in place, keeping its current level and waiters."""
+    limiter.max_rate = max_rate
+    # AsyncLimiter caches the per-second rate it leaks at (a private attribute,
+    # hence the upper bound on the aiolimiter version)
+    limiter._rate_per_sec = max_rate / limiter.time_period
+
+
+async def acquire_tokens(prompt_tokens: int) -> None:
+    """Wait until the token bucket has room for a prompt."""
+    amount = min(prompt_tokens, _tpm_limiter.max_rate)
+    _tpm_pending[amount] += 1
+    try:
+        await _tpm_limiter.acquire(amount)
+    finally:
+        _tpm_pending[amount] -= 1
+        if not _tpm_pending[amount]:
+            del _tpm_pending[amount]
+
+
+def update_rate_limits(headers) -> None:
+    """Resize the rate limiters to match the limits reported by the API."""
+    rpm = headers.get('x-ratelimit-limit-requests')
+    if rpm and rpm.isdigit() and int(rpm) != _rpm_limiter.max_rate:
+        _resize_limiter(_rpm_limiter, int(rpm))
+    
+    tpm = headers.get('x-ratelimit-limit-tokens')
+    if tpm and tpm.isdigit():
+        tpm = max(int(tpm), max(_tpm_pending, default=0))
+        if tpm != _tpm_limiter.max_rate:
+            _resize_limiter(_tpm_limiter, tpm)
+
+
+def get_retry_after(headers) -> Optional[float]:
+    """Get the suggested retry delay in seconds from rate limit response headers."""
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000.0
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        # e.g. retry-after given as an HTTP date
+        pass
+    return None
+
+
+def parse_metadata_response(response_text: Optional[str]) -> Dict:
+    """Parse the JSON metadata from a ChatGPT response."""
+    # Responses are requested in JSON mode, so the content is the JSON itself
+    try:
+        metadata = json_loads(response_text or '')
+    except json.JSONDecodeError:
+        print("Error: Could not parse JSON from ChatGPT response")
+        return {}
+    
+    if not isinstance(metadata, dict):
+        print("Error: ChatGPT response is not a JSON object")
+        return {}
+    
+    # Drop entries that don't follow the requested format rather than failing later
+    invalid = [key for key, value in metadata.items() if not _is_track_metadata(value)]
+    if invalid:
+        print(f"Warning: Ignoring malformed ChatGPT results for: {', '.join(invalid)}")
+    return {key: value for key, value in metadata.items() if key not in invalid}
+
+
+async def get_chatgpt_metadata(client: AsyncOpenAI, tracks: List[Dict]) -> Dict:
+    """Get metadata from ChatGPT for the given tracks."""
+    prompt = build_prompt(tracks)
+    prompt_tokens = count_tokens(prompt)
     max_retries = 5
     base_delay = 1.0
     
     for attempt in range(max_retries):
         try:
-            response = client.chat.completions.create(
+            # Wait for capacity in both buckets before sending
+            await _rpm_limiter.acquire()
+            await acquire_tokens(prompt_tokens)
+            
+            raw_response = await client.chat.completions.with_raw_response.create(
                 model="gpt-5",
                 messages=[{"role": "user", "content": prompt}],
-                reasoning_effort="minimal"
+                reasoning_effort="minimal",
+                response_format={"type": "json_object"}
             )
-                    
-            # Try to parse JSON response
-            response_text = response.choices[0].message.content.strip()
-            
-            # Extract JSON from response (in case there's extra text)
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx >= 0 and end_idx > start_idx:
-                json_text = response_text[start_idx:end_idx]
-                return json.loads(json_text)
-            else:
-                print("Error: Could not parse JSON from ChatGPT response")
-                return {}
+            update_rate_limits(raw_response.headers)
+            response = raw_response.parse()
+            return parse_metadata_response(response.choices[0].message.content)
                 
-        except Exception as e:
-            error_str = str(e)
-            if "rate_limit_exceeded" in error_str or "429" in error_str:
-                if attempt < max_retries - 1:
-                    # Extract wait time from error message if available
-                    wait_time = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                    
-                    # Try to extract suggested wait time from error message
-                    if "Please try again in" in error_str:
-                        try:
-                            import re
-                            match = re.search(r'Please try again in (\d+)ms', error_str)
-                            if match:
-                                suggested_wait = int(match.group(1)) / 1000.0
-                                wait_time = max(wait_time, suggested_wait)
-                        except:
-                            pass
-                    
-                    print(f"Rate limit hit, waiting {wait_time:.1f}s before retry {attempt + 1}/{max_retries}")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"Rate limit exceeded after {max_retries} attempts: {e}")
-                    return {}
+        except RateLimitError as e:
+            if attempt < max_retries - 1:
+                wait_time = base_delay * (2 ** attempt) + random.uniform(0, 1)
+                
+                # Use the wait time suggested by the API if available
+                suggested_wait = get_retry_after(e.response.headers)
+                if suggested_wait is not None:
+                    wait_time = max(wait_time, suggested_wait)
+                
+                print(f"Rate limit hit, waiting {wait_time:.1f}s before retry {attempt + 1}/{max_retries}")
+                await asyncio.sleep(wait_time)
+                continue
             else:
-                print(f"Error calling ChatGPT API: {e}")
+                print(f"Rate limit exceeded after {max_retries} attempts: {e}")
                 return {}
+        except APIError as e:
+            print(f"Error calling ChatGPT API: {e}")
+            return {}
     
     return {}
 
 
-def update_genre_tag(file_path: str, tags: List[str]) -> bool:
-    """Update the genre tag in the music file, adding to existing genres."""
+async def get_batch_api_metadata(client: AsyncOpenAI, batches: List, poll_interval: float = 30.0) -> Dict:
+    """Get metadata for all batches through the OpenAI Batch API."""
+    # Serialize each batch as one chat completion request
+    lines = []
+    for batch, batch_num in batches:
+        tracks = [group[0] for group in batch]
+        lines.append(json.dumps({
+            "custom_id": f"batch-{batch_num}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-5",
+                "messages": [{"role": "user", "content": build_prompt(tracks)}],
+                "reasoning_effort": "minimal",
+                "response_format": {"type": "json_object"}
+            }
+        }))
+    
     try:
-        audio_file = MutagenFile(file_path)
+        input_file = await client.files.create(
+            file=("requests.jsonl", '\n'.join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        job = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except APIError as e:
+        print(f"Error submitting to OpenAI Batch API: {e}")
+        return {}
+    print(f"Submitted batch job {job.id}, waiting for results...")
+    
+    # Poll until the job reaches a terminal state
+    while job.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        await asyncio.sleep(poll_interval)
+        try:
+            job = await client.batches.retrieve(job.id)
+        except APIError as e:
+            # The job keeps running on OpenAI's side, so check again next poll
+            print(f"Error checking batch job {job.id}: {e}")
+            continue
+        if job.request_counts:
+            print(f"Batch job {job.status}: {job.request_counts.completed}/{job.request_counts.total} requests done")
+    
+    if job.status != 'completed':
+        print(f"Error: Batch job {job.id} {job.status}")
+        # Problems with the job as a whole (e.g. input validation)
+        if job.errors and job.errors.data:
+            for error in job.errors.data:
+                print(f"Error: {error.message}")
+    
+    # Expired jobs can still carry partial output, and requests that
+    # failed are listed in a separate error file
+    result_lines = []
+    try:
+        for file_id in (job.output_file_id, job.error_file_id):
+            if file_id:
+                content = await client.files.content(file_id)
+                result_lines.extend(content.text.splitlines())
+    except APIError as e:
+        print(f"Error downloading results of batch job {job.id}: {e}")
+        return {}
+    
+    ai_metadata = {}
+    for line in result_lines:
+        if not line.strip():
+            continue
+        result = json_loads(line)
+        response = result.get('response') or {}
+        if response.get('status_code') != 200:
+            print(f"Error processing {result.get('custom_id')}: {result.get('error') or response.get('body')}")
+            continue
+        ai_metadata.update(parse_metadata_response(response['body']['choices'][0]['message']['content']))
+    
+    return ai_metadata
+
+
+def update_genre_tag(file_path: str, tags: List[str]) -> Optional[str]:
+    """Update the genre tag in the music file, adding to existing genres.
+    
+    Returns None on success, or the error message if the file couldn't be
+    updated.
+    """
+    try:
+        # Re-open the file rather than keeping it from extract_metadata, so
+        # tags edited in the meantime aren't overwritten and parsed files
+        # (including cover art) don't stay in memory for the whole run
+        audio_file = open_audio_file(file_path)
         if audio_file is None:
-            return False
+            return "Unrecognized audio format"
+        
+        if audio_file.tags is None:
+            audio_file.add_tags()
+        
+        # MP3, AIFF and WAV files use ID3 tags; other formats map to a known key
+        is_id3 = isinstance(audio_file.tags, ID3)
+        genre_key = 'TCON' if is_id3 else _GENRE_KEYS.get(type(audio_file), 'GENRE')
         
         # Get existing genre tags
         existing_genres = []
-        
-        # Handle ID3 tags (MP3)
-        if hasattr(audio_file, 'add_tags'):
-            if audio_file.tags is None:
-                audio_file.add_tags()
-            if 'TCON' in audio_file.tags:
-                existing_text = str(audio_file.tags['TCON'])
-                if existing_text:
-                    existing_genres = [g.strip() for g in existing_text.split(' - ')]
-        # Handle other formats
-        elif 'TCON' in audio_file:
-            # TCON can be a list, handle properly
-            if audio_file['TCON']:
-                if isinstance(audio_file['TCON'], list):
-                    existing_text = str(audio_file['TCON'][0])
-                else:
-                    existing_text = str(audio_file['TCON'])
-                if existing_text and not existing_text.startswith('['):
-                    existing_genres = [g.strip() for g in existing_text.split(' - ')]
-        elif '\xa9gen' in audio_file:  # M4A
-            existing_text = str(audio_file['\xa9gen'][0]) if audio_file['\xa9gen'] else ''
-            if existing_text:
-                existing_genres = [g.strip() for g in existing_text.split(' - ')]
-        elif 'GENRE' in audio_file:
-            existing_text = str(audio_file['GENRE'][0]) if audio_file['GENRE'] else ''
-            if existing_text:
-                existing_genres = [g.strip() for g in existing_text.split(' - ')]
+        if is_id3:
+            existing_text = str(audio_file.tags['TCON']) if 'TCON' in audio_file.tags else ''
+        else:
+            values = audio_file.tags.get(genre_key)
+            existing_text = str(values[0]) if values else ''
+        if existing_text:
+            existing_genres = [g.strip() for g in existing_text.split(' - ')]
         
         # Combine existing and new tags, remove duplicates while preserving order
         all_tags = existing_genres + tags
@@ -215,34 +524,87 @@ def update_genre_tag(file_path: str, tags: List[str]) -> bool:
         # Create combined genre string
         genre_string = ' - '.join(unique_tags)
         
-        # Update the appropriate field based on file type
-        file_type = type(audio_file).__name__
-        
-        if file_type == 'MP4':
-            # M4A/ALAC files - write to ©gen field
-            audio_file['\xa9gen'] = [genre_string]
-        elif file_type in ['MP3', 'AIFF'] or hasattr(audio_file, 'add_tags'):
-            # MP3 and AIFF files with ID3 tags
-            if audio_file.tags is None:
-                audio_file.add_tags()
+        if is_id3:
             audio_file.tags['TCON'] = TCON(encoding=3, text=genre_string)
-        elif 'TCON' in audio_file:
-            audio_file['TCON'] = [genre_string]
         else:
-            # Generic approach for other formats
-            audio_file['GENRE'] = [genre_string]
+            audio_file.tags[genre_key] = [genre_string]
         
         audio_file.save()
-        return True
+        return None
         
     except Exception as e:
-        print(f"Error updating {file_path}: {e}")
-        return False
+        return str(e)
+
+
+def tag_tracks(tracks: List[Dict], ai_metadata: Dict, dry_run: bool = False) -> List[str]:
+    """Add the AI tags to each track's file (or just report them on a dry run).
+    
+    Returns a status line per track rather than printing it, so output from
+    worker threads doesn't interleave with the event loop's progress messages.
+    """
+    report = []
+    for track in tracks:
+        metadata = ai_metadata.get(track['track_key'])
+        if metadata is None:
+            report.append(f"{track['file_path']}: No AI metadata found")
+            continue
+        if not isinstance(metadata, dict):
+            report.append(f"{track['file_path']}: Ignoring malformed AI metadata")
+            continue
+        
+        # One bad entry shouldn't stop the rest of the batch from being tagged
+        try:
+            region = metadata.get('region', ())
+            if not isinstance(region, list):
+                region = (region,)
+            
+            # Collect genres, regions, and era, removing duplicates in the same pass
+            seen = set()
+            unique_tags = [
+                tag for tag in chain(metadata.get('genres', ()), region, (metadata.get('era'),))
+                if tag and not (tag in seen or seen.add(tag))
+            ]
+            
+            if unique_tags:
+                if dry_run:
+                    report.append(f"{track['file_path']}: Would add tags: {' - '.join(unique_tags)}")
+                else:
+                    error = update_genre_tag(track['file_path'], unique_tags)
+                    if error is None:
+                        report.append(f"{track['file_path']}: Added tags: {' - '.join(unique_tags)}")
+                    else:
+                        report.append(f"{track['file_path']}: Failed to update tags: {error}")
+            else:
+                report.append(f"{track['file_path']}: No tags found")
+        except Exception as e:
+            report.append(f"{track['file_path']}: Error tagging: {e}")
+    
+    return report
+
+
+def _walk_audio_files(path: str):
+    """Recursively yield directory entries for audio files under path."""
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _walk_audio_files(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS:
+                    yield entry
+    except OSError:
+        # Skip directories we can't read
+        return
+
+
+async def write_tags(tracks: List[Dict], ai_metadata: Dict, dry_run: bool = False) -> None:
+    """Run tag_tracks in a worker thread and print its report."""
+    report = await asyncio.to_thread(tag_tracks, tracks, ai_metadata, dry_run)
+    if report:
+        print('\n'.join(report))
 
 
 def find_audio_files(path: str, since_date: Optional[datetime] = None) -> List[str]:
     """Find audio files in a directory, optionally filtered by creation date."""
-    audio_extensions = {'.mp3', '.m4a', '.flac', '.wav', '.aac', '.ogg', '.wma', '.aif', '.aiff'}
     files = []
     
     path_obj = Path(path)
@@ -252,31 +614,38 @@ def find_audio_files(path: str, since_date: Optional[datetime] = None) -> List[s
     if not path_obj.is_dir():
         return []
     
-    for file_path in path_obj.rglob('*'):
-        if file_path.suffix.lower() in audio_extensions:
-            if since_date:
-                # Get creation time (birth time on macOS, ctime on others)
-                try:
-                    if hasattr(os.stat_result, 'st_birthtime'):
-                        # macOS - use birth time
-                        stat = file_path.stat()
-                        created = datetime.fromtimestamp(stat.st_birthtime)
-                    else:
-                        # Linux/Windows - use ctime as best approximation
-                        stat = file_path.stat()
-                        created = datetime.fromtimestamp(stat.st_ctime)
-                    
-                    if created >= since_date:
-                        files.append(str(file_path))
-                except (OSError, AttributeError):
-                    # If we can't get creation time, skip the file
-                    continue
-            else:
-                files.append(str(file_path))
+    # Compare raw timestamps rather than building a datetime per file
+    since_ts = since_date.timestamp() if since_date else None
+    
+    for entry in _walk_audio_files(path):
+        if since_ts is not None:
+            # Get creation time (birth time on macOS, ctime on others)
+            try:
+                stat = entry.stat()
+                created = stat.st_birthtime if _HAS_BIRTHTIME else stat.st_ctime
+                
+                if created >= since_ts:
+                    files.append(str(Path(entry.path)))
+            except OSError:
+                # If we can't get creation time, skip the file
+                continue
+        else:
+            files.append(str(Path(entry.path)))
     
     return sorted(files)
 
 
+def positive_int(value: str) -> int:
+    """Parse a command line argument that must be an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"Must be at least 1: {value}")
+    return number
+
+
 def parse_since_date(since_str: str) -> datetime:
     """Parse --since argument into datetime."""
     if since_str.endswith('d'):
@@ -295,7 +664,7 @@ def parse_since_date(since_str: str) -> datetime:
             raise argparse.ArgumentTypeError(f"Invalid date format: {since_str}. Use YYYY-MM-DD, Nd (N days ago), or Nh (N hours ago)")
 
 
-def main():
+async def main_async():
     # Load environment variables from .env file if present
     load_dotenv()
     
@@ -304,7 +673,10 @@ def main():
     parser.add_argument('--dry-run', action='store_true', help='Show what would be done without making changes')
     parser.add_argument('--api-key', help='OpenAI API key (or set OPENAI_API_KEY env var)')
     parser.add_argument('--since', type=parse_since_date, help='Only process files created since this date/time. Format: YYYY-MM-DD, 7d (7 days ago), or 24h (24 hours ago)')
-    parser.add_argument('--workers', type=int, default=5, help='Number of parallel workers for processing batches (default: 5)')
+    parser.add_argument('--workers', type=positive_int, default=5, help='Maximum number of concurrent API requests (default: 5)')
+    parser.add_argument('--batch-size', type=positive_int, help=f'Number of tracks per request (default: as many as fit in ~{TARGET_PROMPT_TOKENS} prompt tokens, split over --workers requests where possible)')
+    parser.add_argument('--batch-api', action='store_true', help='Submit all batches through the OpenAI Batch API (cheaper, but may take up to 24h)')
+    parser.add_argument('--no-cache', action='store_true', help=f'Skip the cache of previous AI results ({CACHE_PATH}) and query every track')
     
     args = parser.parse_args()
     
@@ -327,14 +699,20 @@ def main():
     if args.since and all_files:
         print(f"Found {len(all_files)} audio files created since {args.since.strftime('%Y-%m-%d %H:%M:%S')}")
     
-    # Process files
+    # Read metadata from all files in parallel
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as executor:
+        all_metadata = list(executor.map(extract_metadata, all_files))
+    
     tracks = []
-    for file_path in all_files:
-        metadata = extract_metadata(file_path)
+    for file_path, metadata in zip(all_files, all_metadata):
         if metadata:
+            # Key the AI results are returned under, built once per track
+            artist = metadata.get('artist', 'Unknown')
+            title = metadata.get('title', 'Unknown')
             tracks.append({
                 'file_path': file_path,
-                'metadata': metadata
+                'metadata': metadata,
+                'track_key': f"{artist} - {title}"
             })
         else:
             print(f"Warning: Could not read metadata from {file_path}")
@@ -345,78 +723,89 @@ def main():
     
     print(f"Processing {len(tracks)} tracks...")
     
-    # Process tracks in batches of 10 with parallel workers
-    ai_metadata = {}
-    batch_size = 10
-    total_batches = (len(tracks) + batch_size - 1) // batch_size
+    # Group copies of the same track (e.g. in several folders) so each
+    # distinct track is only looked up and sent to ChatGPT once
+    track_groups = {}
+    for track in tracks:
+        metadata = track['metadata']
+        key = (metadata.get('artist'), metadata.get('title'), metadata.get('album'))
+        track_groups.setdefault(key, []).append(track)
+    
+    # Reuse AI metadata from previous runs where available
+    cache = None if args.no_cache else open_cache(CACHE_PATH)
+    cached_metadata = {}
+    cached_tracks = []
+    uncached_groups = []
+    for group in track_groups.values():
+        track = group[0]
+        cached = cache_get(cache, track['metadata']) if cache else None
+        if cached is not None:
+            cached_metadata[track['track_key']] = cached
+            cached_tracks.extend(group)
+        else:
+            uncached_groups.append(group)
+    
+    if cache:
+        print(f"Found {len(cached_tracks)} tracks in cache")
+    
+    # Tag cached tracks in the background while the rest go to ChatGPT
+    writes = [asyncio.create_task(write_tags(cached_tracks, cached_metadata, args.dry_run))]
+    
+    # Process tracks in batches sized to amortize per-request overhead
+    if args.batch_size:
+        batch_size = args.batch_size
+    elif uncached_groups:
+        # The Batch API runs a job's requests on its own, so there's no need
+        # to split the tracks over --workers requests
+        min_batches = 1 if args.batch_api else args.workers
+        batch_size = choose_batch_size([group[0] for group in uncached_groups], min_batches)
+    else:
+        batch_size = 10
+    total_batches = (len(uncached_groups) + batch_size - 1) // batch_size
     
     # Create batches
     batches = []
-    for i in range(0, len(tracks), batch_size):
-        batch = tracks[i:i + batch_size]
+    for i in range(0, len(uncached_groups), batch_size):
+        batch = uncached_groups[i:i + batch_size]
         batch_num = i // batch_size + 1
         batches.append((batch, batch_num))
     
-    # Process batches in parallel
-    print(f"Processing {len(tracks)} tracks in {total_batches} batches using {args.workers} workers...")
+    if batches:
+        # One client for the whole run so every request reuses the same
+        # HTTP/2 connection pool instead of paying for a new TLS handshake
+        http_client = DefaultAsyncHttpxClient(http2=True, limits=httpx.Limits(max_connections=50))
+        async with AsyncOpenAI(api_key=api_key, http_client=http_client) as client:
+            if args.batch_api:
+                print(f"Submitting {len(uncached_groups)} unique tracks in {total_batches} batches to the OpenAI Batch API...")
+                ai_metadata = await get_batch_api_metadata(client, batches)
+                if cache:
+                    cache_put(cache, [group[0] for group in uncached_groups], ai_metadata)
+                await write_tags([track for group in uncached_groups for track in group], ai_metadata, args.dry_run)
+            else:
+                # Submit every batch at once on a single event loop
+                print(f"Processing {len(uncached_groups)} unique tracks in {total_batches} batches with up to {args.workers} concurrent requests...")
+                
+                semaphore = asyncio.Semaphore(args.workers)
+                coros = [
+                    process_batch(client, batch, batch_num, total_batches, semaphore, cache)
+                    for batch, batch_num in batches
+                ]
+                
+                # Start tagging each batch's files as soon as it completes, so
+                # write work overlaps the batches that are still in flight
+                for next_batch in asyncio.as_completed(coros):
+                    batch, batch_metadata = await next_batch
+                    tracks_to_tag = [track for group in batch for track in group]
+                    writes.append(asyncio.create_task(write_tags(tracks_to_tag, batch_metadata, args.dry_run)))
     
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        # Submit all batches
-        future_to_batch = {
-            executor.submit(process_batch, batch, api_key, batch_num, total_batches): batch_num 
-            for batch, batch_num in batches
-        }
-        
-        # Collect results as they complete
-        for future in as_completed(future_to_batch):
-            batch_num = future_to_batch[future]
-            try:
-                batch_metadata = future.result()
-                ai_metadata.update(batch_metadata)
-                print(f"Completed batch {batch_num}/{total_batches}")
-            except Exception as e:
-                print(f"Error processing batch {batch_num}: {e}")
+    await asyncio.gather(*writes)
     
-    # Process results
-    for track in tracks:
-        artist = track['metadata'].get('artist', 'Unknown')
-        title = track['metadata'].get('title', 'Unknown')
-        track_key = f"{artist} - {title}"
-        
-        if track_key in ai_metadata:
-            tags = []
-            metadata = ai_metadata[track_key]
-            
-            # Add genres
-            if 'genres' in metadata:
-                tags.extend(metadata['genres'])
-            
-            # Add region
-            if 'region' in metadata:
-                if isinstance(metadata['region'], list):
-                    tags.extend(metadata['region'])
-                else:
-                    tags.append(metadata['region'])
-            
-            # Add era
-            if 'era' in metadata:
-                tags.append(metadata['era'])
-            
-            if tags:
-                # Remove duplicates while preserving order
-                unique_tags = list(dict.fromkeys(tags))
-                
-                if args.dry_run:
-                    print(f"{track['file_path']}: Would add tags: {' - '.join(unique_tags)}")
-                else:
-                    if update_genre_tag(track['file_path'], unique_tags):
-                        print(f"{track['file_path']}: Added tags: {' - '.join(unique_tags)}")
-                    else:
-                        print(f"{track['file_path']}: Failed to update tags")
-            else:
-                print(f"{track['file_path']}: No tags found")
-        else:
-            print(f"{track['file_path']}: No AI metadata found")
+    if cache:
+        cache.close()
+
+
+def main():
+    asyncio.run(main_async())
 
 
 if __name__ == '__main__':